@@ -2,12 +2,24 @@ import os
 import streamlit as st
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Deque, Dict, Any, Iterable, Iterator, NamedTuple, Optional, Set, Union
 import pickle
 from datetime import datetime
+from collections import OrderedDict, defaultdict, deque
+import heapq
+from itertools import groupby, islice
+import math
+from operator import attrgetter, itemgetter
 import logging
 import traceback
+import time
+import re
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,75 +31,253 @@ load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 MEM0_API_KEY = os.getenv("MEM0_API_KEY")
 
-# Try to import mem0, if it fails, use local memory storage
+# Number of recent messages sent to the model as conversation context
+HISTORY_WINDOW = 8
+
+# Messages kept in a session's on-screen history; older ones are dropped
+MAX_SESSION_HISTORY = 256
+
+# Messages rendered in the conversation view before older ones are hidden
+RENDERED_HISTORY = 200
+
+# Approximate token budget for the history plus the new user message
+HISTORY_TOKEN_BUDGET = 3000
+
+# Re-sending the last message within this many seconds is treated as a spurious rerun
+DUPLICATE_SEND_WINDOW = 2.0
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant. Provide clear and helpful responses to user questions."
+
+MEMORY_SYSTEM_PROMPT = """You are a helpful AI assistant with access to previous conversation memories.
+
+Here are relevant memories from our past conversations:
+{memory_text}
+
+Please use this context to provide more personalized and relevant responses. Reference the memories naturally if they're relevant to the current question."""
+
+# Use orjson for faster JSON encoding/decoding when available
 try:
-    from mem0 import MemoryClient
-    USE_MEM0 = True
-    memory_client = MemoryClient(api_key=MEM0_API_KEY) if MEM0_API_KEY else None
-    logger.info("Mem0 successfully imported")
-except ImportError as e:
-    USE_MEM0 = False
-    memory_client = None
-    logger.warning(f"Mem0 import failed: {e}")
-except Exception as e:
-    USE_MEM0 = False
-    memory_client = None
-    logger.error(f"Unexpected error importing Mem0: {e}")
-
-class SafeDict:
-    """Safe dictionary wrapper to handle missing keys gracefully"""
-    
-    def __init__(self, data: Any):
-        if isinstance(data, dict):
-            self.data = data
-        elif isinstance(data, list):
-            self.data = {"results": data}
-        else:
-            self.data = {}
+    import orjson
+    USE_ORJSON = True
+except ImportError:
+    USE_ORJSON = False
+
+def _json_dumps(obj: Any) -> bytes:
+    """Serialize obj to UTF-8 JSON bytes"""
+    if USE_ORJSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def _json_loads(data: Union[bytes, str]) -> Any:
+    """Parse JSON from bytes or str"""
+    if USE_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens, dropping punctuation"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+class TokenTrie:
+    """Prefix trie over memory tokens; each token's final node holds the memories containing it"""
     
-    def get(self, key: str, default: Any = None) -> Any:
-        """Safely get value from dictionary"""
-        try:
-            return self.data.get(key, default)
-        except AttributeError:
-            return default
+    def __init__(self):
+        self.children: Dict[str, "TokenTrie"] = {}
+        self.positions: Set[int] = set()
     
-    def __getitem__(self, key: str) -> Any:
-        """Safely get item from dictionary"""
-        try:
-            return self.data[key]
-        except (KeyError, TypeError):
-            return None
+    def insert(self, tokens: Iterable[str], position: int) -> None:
+        """Record that the memory at position contains the given tokens"""
+        for token in tokens:
+            node = self
+            for char in token:
+                node = node.children.setdefault(char, TokenTrie())
+            node.positions.add(position)
+    
+    def walk(self, prefix: str) -> Set[int]:
+        """Return positions of memories containing a token that starts with prefix"""
+        node = self
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+        
+        # Collect the positions of every token under the prefix node
+        positions: Set[int] = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            positions |= node.positions
+            stack.extend(node.children.values())
+        return positions
 
 class LocalMemory:
     """Local memory storage as fallback when mem0 is not available"""
     
-    def __init__(self, storage_file: str = "memory_storage.pkl"):
+    def __init__(self, storage_file: str = "memory_storage.jsonl", legacy_file: str = "memory_storage.pkl"):
         self.storage_file = storage_file
+        self.legacy_file = legacy_file
+        # One instance is shared by every session, so guard mutations and reads
+        self._lock = threading.RLock()
+        # Records in the log file, including ones superseded by a later clear
+        self._log_records = 0
+        # While a legacy pickle is unmigrated the log is neither created nor appended to,
+        # so the pickle stays the source of truth until a full rewrite succeeds
+        self._migration_pending = False
+        # Set when the log could not be read in full; compaction would then drop unread records
+        self._load_failed = False
+        # Shown once in the UI when unreadable saved memories had to be set aside
+        self.load_warning: Optional[str] = None
         self.memories = self._load_memories()
+        # Token prefix index per user over positions in self.memories[user_id]
+        self.index: Dict[str, TokenTrie] = {}
+        for user_id, user_memories in self.memories.items():
+            for position, entry in enumerate(user_memories):
+                self._index_entry(user_id, position, entry)
+        self._append_fh = None if self._migration_pending else self._open_log()
+        self._maybe_compact()
+    
+    def _index_entry(self, user_id: str, position: int, entry: Dict) -> None:
+        """Add a memory's content tokens to the user's prefix index"""
+        if not isinstance(entry, dict):
+            return
+        tokens = set(tokenize(str(entry.get("content", ""))))
+        self.index.setdefault(user_id, TokenTrie()).insert(tokens, position)
+    
+    def _open_log(self):
+        """Open the memory log for appends"""
+        fh = open(self.storage_file, 'ab')
+        # Terminate a torn final line so the next record starts on its own line
+        if fh.tell() > 0:
+            with open(self.storage_file, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    fh.write(b"\n")
+                    fh.flush()
+        return fh
     
     def _load_memories(self) -> Dict[str, List[Dict]]:
-        """Load memories from local file"""
+        """Load memories from the JSON-lines log, migrating the legacy pickle if needed"""
         try:
+            if not os.path.exists(self.storage_file) and os.path.exists(self.legacy_file):
+                self._migration_pending = True
+                return self._migrate_legacy_pickle()
+            
+            memories: Dict[str, List[Dict]] = {}
             if os.path.exists(self.storage_file):
                 with open(self.storage_file, 'rb') as f:
-                    data = pickle.load(f)
-                    # Ensure data is a dictionary
-                    return data if isinstance(data, dict) else {}
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = _json_loads(line)
+                        except ValueError:
+                            # A torn write from a crash only affects the last line
+                            logger.warning("Skipping unreadable memory record")
+                            continue
+                        
+                        user_id = record.pop("user_id", None) if isinstance(record, dict) else None
+                        if user_id is None:
+                            continue
+                        
+                        self._log_records += 1
+                        if record.get("op") == "clear":
+                            memories.pop(str(user_id), None)
+                        else:
+                            memories.setdefault(str(user_id), []).append(record)
+            return memories
         except Exception as e:
             logger.error(f"Error loading memories: {e}")
+            self._load_failed = True
         return {}
     
-    def _save_memories(self) -> bool:
-        """Save memories to local file"""
+    def _migrate_legacy_pickle(self) -> Dict[str, List[Dict]]:
+        """Convert memories saved by the old pickle format into the JSON-lines log"""
         try:
-            with open(self.storage_file, 'wb') as f:
-                pickle.dump(self.memories, f)
+            with open(self.legacy_file, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.error(f"Error loading {self.legacy_file}: {e}")
+            self._set_aside_legacy_pickle()
+            data = {}
+        # Ensure data is a dictionary
+        memories = data if isinstance(data, dict) else {}
+        if self._write_log(memories):
+            self._migration_pending = False
+            self._log_records = sum(len(user_memories) for user_memories in memories.values())
+            logger.info(f"Migrated memories from {self.legacy_file} to {self.storage_file}")
+        return memories
+    
+    def _set_aside_legacy_pickle(self) -> None:
+        """Move an unreadable legacy pickle out of the way so a fresh log can be started"""
+        corrupt_file = f"{self.legacy_file}.corrupt"
+        try:
+            os.replace(self.legacy_file, corrupt_file)
+            self.load_warning = f"Saved memories in {self.legacy_file} could not be read and were moved to {corrupt_file}; starting with empty memory."
+        except OSError as e:
+            logger.error(f"Error moving {self.legacy_file} aside: {e}")
+            self.load_warning = f"Saved memories in {self.legacy_file} could not be read; starting with empty memory."
+        logger.warning(self.load_warning)
+    
+    def _write_log(self, memories: Dict[str, List[Dict]]) -> bool:
+        """Atomically rewrite the whole log from the given memories"""
+        try:
+            tmp_file = f"{self.storage_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                for user_id, user_memories in memories.items():
+                    for entry in user_memories:
+                        if not isinstance(entry, dict):
+                            continue
+                        f.write(_json_dumps({"user_id": user_id, **entry}) + b"\n")
+            os.replace(tmp_file, self.storage_file)
             return True
         except Exception as e:
             logger.error(f"Error saving memories: {e}")
             return False
     
+    def _append_records(self, records: List[Dict]) -> bool:
+        """Append records, already applied to self.memories, to the log without rewriting it"""
+        if self._append_fh is None:
+            return self._finish_migration()
+        
+        try:
+            self._append_fh.write(b"".join(_json_dumps(record) + b"\n" for record in records))
+            self._append_fh.flush()
+            self._log_records += len(records)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving memories: {e}")
+            return False
+    
+    def _finish_migration(self) -> bool:
+        """Retry writing the initial log from the legacy memories plus anything added since"""
+        if not self._write_log(self.memories):
+            return False
+        
+        self._migration_pending = False
+        self._log_records = sum(len(user_memories) for user_memories in self.memories.values())
+        self._append_fh = self._open_log()
+        logger.info(f"Migrated memories from {self.legacy_file} to {self.storage_file}")
+        return True
+    
+    def _maybe_compact(self) -> None:
+        """Rewrite the log from live memories once cleared records make up most of it"""
+        if self._append_fh is None or self._load_failed:
+            return
+        
+        live_records = sum(len(user_memories) for user_memories in self.memories.values())
+        if self._log_records <= 2 * live_records:
+            return
+        
+        # Reopen the append handle on the rewritten file
+        self._append_fh.close()
+        if self._write_log(self.memories):
+            logger.info(f"Compacted memory log from {self._log_records} to {live_records} records")
+            self._log_records = live_records
+        self._append_fh = self._open_log()
+    
     def add(self, messages: Union[List[Dict], Dict], user_id: str, **kwargs) -> bool:
         """Add messages to memory"""
         try:
@@ -98,27 +288,33 @@ class LocalMemory:
                 logger.error(f"Invalid messages type: {type(messages)}")
                 return False
             
-            # Initialize user memory if not exists
-            if user_id not in self.memories:
-                self.memories[user_id] = []
-            
-            # Process each message
-            for message in messages:
-                if not isinstance(message, dict):
-                    continue
+            with self._lock:
+                # Initialize user memory if not exists
+                if user_id not in self.memories:
+                    self.memories[user_id] = []
                 
-                content = message.get("content", "")
-                role = message.get("role", "unknown")
+                # Process each message
+                new_entries = []
+                for message in messages:
+                    if not isinstance(message, dict):
+                        continue
+                    
+                    content = message.get("content", "")
+                    role = message.get("role", "unknown")
+                    
+                    memory_entry = {
+                        "content": str(content),
+                        "role": str(role),
+                        "timestamp": datetime.now().isoformat(),
+                        "memory": f"{role}: {content}"
+                    }
+                    new_entries.append(memory_entry)
                 
-                memory_entry = {
-                    "content": str(content),
-                    "role": str(role),
-                    "timestamp": datetime.now().isoformat(),
-                    "memory": f"{role}: {content}"
-                }
-                self.memories[user_id].append(memory_entry)
-            
-            return self._save_memories()
+                start = len(self.memories[user_id])
+                self.memories[user_id].extend(new_entries)
+                for position, entry in enumerate(new_entries, start):
+                    self._index_entry(user_id, position, entry)
+                return self._append_records([{"user_id": user_id, **entry} for entry in new_entries])
             
         except Exception as e:
             logger.error(f"Error adding memory: {e}")
@@ -133,36 +329,54 @@ class LocalMemory:
             if not isinstance(user_id, str):
                 user_id = str(user_id)
             
-            if user_id not in self.memories:
-                return {"results": []}
+            # Keyword search: a query word matches memories with a token it prefixes,
+            # so "vegetarian" also matches "vegetarians"
+            query_words = tokenize(query)
             
-            user_memories = self.memories[user_id]
-            if not isinstance(user_memories, list):
-                return {"results": []}
-            
-            # Simple keyword-based search
-            query_words = query.lower().split()
-            scored_memories = []
-            
-            for memory in user_memories:
-                if not isinstance(memory, dict):
-                    continue
-                    
-                content = str(memory.get("content", "")).lower()
-                score = sum(1 for word in query_words if word in content)
+            with self._lock:
+                user_memories = self.memories.get(user_id, [])
+                user_index = self.index.get(user_id)
+                if user_index is None:
+                    return {"results": []}
                 
-                if score > 0:
-                    scored_memories.append((score, memory))
-            
-            # Sort by relevance and return top results
-            scored_memories.sort(key=lambda x: x[0], reverse=True)
-            results = [memory for _, memory in scored_memories[:limit]]
+                # Weight each matched word by its inverse document frequency so rare
+                # words count for more than ones found in most memories
+                scores: Dict[int, float] = defaultdict(float)
+                for word in query_words:
+                    positions = user_index.walk(word)
+                    if not positions:
+                        continue
+                    idf = math.log(1 + len(user_memories) / len(positions))
+                    for position in positions:
+                        scores[position] += idf
+                
+                # Return the most relevant memories
+                top = heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+                results = [user_memories[position] for position, _ in top]
             
             return {"results": results}
             
         except Exception as e:
             logger.error(f"Error searching memories: {e}")
             return {"results": []}
+    
+    def count(self, user_id: str) -> Optional[int]:
+        """Number of memories stored for a user"""
+        with self._lock:
+            return len(self.memories.get(user_id, []))
+    
+    def clear(self, user_id: str) -> bool:
+        """Delete all memories stored for a user"""
+        with self._lock:
+            if user_id not in self.memories:
+                return False
+            del self.memories[user_id]
+            self.index.pop(user_id, None)
+            
+            # Log the clear instead of rewriting the file; compaction reclaims the old records
+            saved = self._append_records([{"user_id": user_id, "op": "clear"}])
+            self._maybe_compact()
+            return saved
 
 class Mem0Wrapper:
     """Wrapper for Mem0 client with error handling"""
@@ -198,86 +412,254 @@ class Mem0Wrapper:
         except Exception as e:
             logger.error(f"Error searching Mem0: {e}")
             return {"results": []}
+    
+    def count(self, user_id: str) -> Optional[int]:
+        """Number of memories stored in Mem0 for a user, or None if unavailable"""
+        try:
+            result = self.client.get_all(user_id=user_id)
+            
+            # Handle different response formats
+            if isinstance(result, dict):
+                result = result.get("results", [])
+            return len(result) if isinstance(result, list) else None
+            
+        except Exception as e:
+            logger.error(f"Error counting Mem0 memories: {e}")
+            return None
+
+def create_mem0_client():
+    """Import mem0 on demand and build its client; None if mem0 is not installed"""
+    # Try to import mem0, if it fails, use local memory storage
+    try:
+        from mem0 import MemoryClient
+        logger.info("Mem0 successfully imported")
+    except ImportError as e:
+        logger.warning(f"Mem0 import failed: {e}")
+        return None
+    return MemoryClient(api_key=MEM0_API_KEY)
+
+@st.cache_resource(show_spinner=False)
+def get_mem0_memory() -> Optional[Mem0Wrapper]:
+    """Connect to Mem0 once per server process; errors propagate and are not cached"""
+    client = create_mem0_client()
+    return Mem0Wrapper(client) if client is not None else None
+
+@st.cache_resource(show_spinner=False)
+def get_local_memory() -> LocalMemory:
+    """Local memory store shared by every session"""
+    return LocalMemory()
 
 def initialize_memory():
-    """Initialize memory system with error handling"""
+    """Pick the memory system, falling back to local storage while Mem0 is unavailable"""
+    if not MEM0_API_KEY:
+        return get_local_memory(), "Local Storage"
     try:
-        if USE_MEM0 and memory_client:
-            return Mem0Wrapper(memory_client), "Mem0 Cloud"
-        else:
-            return LocalMemory(), "Local Storage"
+        mem0_memory = get_mem0_memory()
     except Exception as e:
+        # Nothing was cached, so Mem0 is tried again on the next rerun
         logger.error(f"Error initializing memory: {e}")
-        return LocalMemory(), "Local Storage (Fallback)"
+        return get_local_memory(), "Local Storage (Fallback)"
+    if mem0_memory is None:
+        return get_local_memory(), "Local Storage"
+    return mem0_memory, "Mem0 Cloud"
 
-def groq_chat(prompt: str, messages: Optional[List[Dict]] = None) -> str:
-    """Send chat request to Groq API with comprehensive error handling"""
-    if messages is None:
-        messages = []
+class MemoryWriteBuffer:
+    """Batches memory writes and flushes them from a background thread"""
+    
+    def __init__(self, memory_system, flush_interval: float = 2.0, max_pending: int = 6):
+        self.memory_system = memory_system
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[str, List[Dict]] = {}
+        self._lock = threading.Lock()
+        # Held for a whole batch write so a clear cannot interleave with it
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        # Advances after every flush that wrote something, for cache invalidation
+        self.epoch = 0
+        self._thread = threading.Thread(target=self._run, name="memory-writer", daemon=True)
+        self._thread.start()
+        # Don't lose buffered turns when the server shuts down
+        atexit.register(self.flush)
+    
+    def add(self, messages: List[Dict], user_id: str) -> None:
+        """Queue messages for the next flush"""
+        with self._lock:
+            pending = self._pending.setdefault(user_id, [])
+            pending.extend(messages)
+            if len(pending) >= self.max_pending:
+                self._wake.set()
+    
+    def clear(self, user_id: str) -> bool:
+        """Drop queued messages for a user and clear their stored memories"""
+        # Waiting for any in-flight flush keeps it from writing turns back after the clear
+        with self._flush_lock:
+            with self._lock:
+                self._pending.pop(user_id, None)
+            return self.memory_system.clear(user_id)
+    
+    def flush(self) -> bool:
+        """Write all queued messages, one add call per user"""
+        with self._flush_lock:
+            with self._lock:
+                batches, self._pending = self._pending, {}
+            
+            success = True
+            for user_id, messages in batches.items():
+                if not self.memory_system.add(messages=messages, user_id=user_id):
+                    logger.error(f"Failed to save {len(messages)} messages to memory for user {user_id}")
+                    success = False
+            if batches:
+                self.epoch += 1
+            return success
     
+    def _run(self) -> None:
+        """Flush every flush_interval seconds, or sooner once max_pending is reached"""
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing memory writes: {e}")
+
+class CachedMemorySearch:
+    """Serves repeated (user_id, query) searches from a TTL cache that is safe to use off the script thread"""
+
+    def __init__(self, memory_system, ttl: float = 60.0, max_entries: int = 512):
+        self.memory_system = memory_system
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def search(self, query: str, user_id: str, limit: int = 3) -> Dict[str, List[Dict]]:
+        """Search memories, reusing a cached result younger than ttl"""
+        key = (user_id, query, limit)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and now - cached[0] < self.ttl:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        result = self.memory_system.search(query=query, user_id=user_id, limit=limit)
+        with self._lock:
+            self._cache[key] = (now, result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return result
+
+    def clear(self) -> None:
+        """Drop every cached search result"""
+        with self._lock:
+            self._cache.clear()
+
+GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+VALID_ROLES = frozenset(("system", "user", "assistant"))
+
+# (connect, read) timeouts: fail fast on an unreachable host, allow slow generations
+GROQ_TIMEOUT = (3.05, 30)
+
+@st.cache_resource(show_spinner=False)
+def get_groq_session() -> requests.Session:
+    """Create a pooled HTTP session shared across reruns so TLS connections are reused"""
+    session = requests.Session()
+    # Retry connect failures and transient server errors; the final response is returned so
+    # status handling still applies. read=False re-raises read errors unretried, so a slow
+    # generation is never re-sent and surfaces as a ReadTimeout rather than a ConnectionError.
+    retries = Retry(
+        total=2,
+        read=False,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=retries))
+    session.headers.update({
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json",
+    })
+    return session
+
+def _build_groq_payload(messages: List[Dict], stream: bool) -> Dict[str, Any]:
+    """Validate the assembled conversation and build the Groq chat completion payload"""
+    # Validate and clean messages in one pass, keeping valid roles with non-empty content
+    clean_messages = [
+        {"role": role, "content": content}
+        for role, content in (
+            (str(msg["role"]).strip().lower(), str(msg["content"]).strip())
+            for msg in messages
+            if isinstance(msg, dict) and "role" in msg and "content" in msg
+        )
+        if role in VALID_ROLES and content
+    ]
+    
+    # Use a supported model
+    return {
+        "model": "llama3-8b-8192",  # Changed to a more reliable model
+        "messages": clean_messages,
+        "temperature": 0.7,
+        "max_tokens": 1024,
+        "top_p": 1,
+        "stream": stream
+    }
+
+def _groq_status_error(response: requests.Response) -> Optional[str]:
+    """Map known Groq error status codes to user-facing messages"""
+    # Log response details for debugging
+    logger.info(f"Response status: {response.status_code}")
+    
+    if response.status_code == 400:
+        error_detail = response.text
+        logger.error(f"Bad request details: {error_detail}")
+        return f"❌ Bad request to Groq API. Please check your API key and try again."
+    
+    if response.status_code == 401:
+        return "❌ Invalid API key. Please check your GROQ_API_KEY in the .env file."
+    
+    if response.status_code == 429:
+        return "❌ Rate limit exceeded. Please wait a moment and try again."
+    
+    return None
+
+def _groq_request_error(error: Exception) -> str:
+    """Map an exception raised while talking to Groq to a user-facing message"""
+    if isinstance(error, requests.exceptions.Timeout):
+        return "❌ Request timed out. Please try again."
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "❌ Connection error. Please check your internet connection."
+    if isinstance(error, requests.exceptions.HTTPError):
+        logger.error(f"HTTP Error: {error}")
+        return f"❌ HTTP error: {error}. Please check your API key and try again."
+    if isinstance(error, json.JSONDecodeError):
+        logger.error(f"JSON decode error: {error}")
+        return "❌ Invalid response format from API"
+    logger.error(f"Unexpected error in groq_chat: {error}")
+    return f"❌ Unexpected error: {str(error)}"
+
+def groq_chat(messages: List[Dict]) -> str:
+    """Send chat request to Groq API with comprehensive error handling"""
     if not GROQ_API_KEY:
         return "❌ GROQ_API_KEY not found in environment variables"
     
-    if not isinstance(prompt, str):
-        prompt = str(prompt)
-    
     try:
-        # Validate and clean messages
-        clean_messages = []
-        for msg in messages:
-            if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                role = str(msg["role"]).strip().lower()
-                content = str(msg["content"]).strip()
-                
-                # Ensure valid roles
-                if role in ["system", "user", "assistant"] and content:
-                    clean_messages.append({
-                        "role": role,
-                        "content": content
-                    })
-        
-        # Add user message
-        if prompt.strip():
-            clean_messages.append({"role": "user", "content": prompt.strip()})
-        
-        # Use correct Groq API endpoint
-        url = "https://api.groq.com/openai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
-        # Use a supported model
-        payload = {
-            "model": "llama3-8b-8192",  # Changed to a more reliable model
-            "messages": clean_messages,
-            "temperature": 0.7,
-            "max_tokens": 1024,
-            "top_p": 1,
-            "stream": False
-        }
-        
-        logger.info(f"Sending request to Groq API with {len(clean_messages)} messages")
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
-        
-        # Log response details for debugging
-        logger.info(f"Response status: {response.status_code}")
+        payload = _build_groq_payload(messages, stream=False)
         
-        if response.status_code == 400:
-            error_detail = response.text
-            logger.error(f"Bad request details: {error_detail}")
-            return f"❌ Bad request to Groq API. Please check your API key and try again."
+        logger.info(f"Sending request to Groq API with {len(payload['messages'])} messages")
         
-        if response.status_code == 401:
-            return "❌ Invalid API key. Please check your GROQ_API_KEY in the .env file."
+        response = get_groq_session().post(GROQ_API_URL, data=_json_dumps(payload), timeout=GROQ_TIMEOUT)
         
-        if response.status_code == 429:
-            return "❌ Rate limit exceeded. Please wait a moment and try again."
+        status_error = _groq_status_error(response)
+        if status_error:
+            return status_error
         
         response.raise_for_status()
         
-        response_data = response.json()
+        response_data = _json_loads(response.content)
         
         # Safely extract the response
         choices = response_data.get("choices", [])
@@ -289,19 +671,74 @@ def groq_chat(prompt: str, messages: Optional[List[Dict]] = None) -> str:
         
         return str(content)
         
-    except requests.exceptions.Timeout:
-        return "❌ Request timed out. Please try again."
-    except requests.exceptions.ConnectionError:
-        return "❌ Connection error. Please check your internet connection."
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"HTTP Error: {e}")
-        return f"❌ HTTP error: {e}. Please check your API key and try again."
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        return "❌ Invalid response format from API"
     except Exception as e:
-        logger.error(f"Unexpected error in groq_chat: {e}")
-        return f"❌ Unexpected error: {str(e)}"
+        return _groq_request_error(e)
+
+def groq_chat_stream(messages: List[Dict]) -> Iterator[str]:
+    """Stream a Groq chat completion, yielding content deltas as they arrive"""
+    if not GROQ_API_KEY:
+        yield "❌ GROQ_API_KEY not found in environment variables"
+        return
+    
+    try:
+        payload = _build_groq_payload(messages, stream=True)
+        
+        logger.info(f"Streaming request to Groq API with {len(payload['messages'])} messages")
+        
+        with get_groq_session().post(GROQ_API_URL, data=_json_dumps(payload), timeout=GROQ_TIMEOUT, stream=True) as response:
+            status_error = _groq_status_error(response)
+            if status_error:
+                yield status_error
+                return
+            
+            response.raise_for_status()
+            
+            # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+            for line in response.iter_lines():
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    break
+                
+                choices = _json_loads(data).get("choices", [])
+                if not choices:
+                    continue
+                
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+                    
+    except Exception as e:
+        yield _groq_request_error(e)
+
+class ChatMessage(NamedTuple):
+    """A conversation turn as stored in session history"""
+    role: str
+    content: str
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token) used for prompt budgeting"""
+    return len(text) // 4 + 1
+
+def select_recent_history(history: Deque[ChatMessage], token_budget: int) -> List[Dict]:
+    """Pick the most recent messages that fit in the token budget, oldest first"""
+    selected = []
+    for msg in islice(reversed(history), HISTORY_WINDOW):
+        token_budget -= estimate_tokens(msg.content)
+        if token_budget < 0:
+            break
+        selected.append({"role": msg.role, "content": msg.content})
+    
+    selected.reverse()
+    return selected
+
+@st.cache_data(ttl=30, show_spinner=False)
+def count_memories(_memory_system, backend: str, user_id: str, epoch: int) -> Optional[int]:
+    """Memory count for the status panel, recomputed whenever the writer epoch advances"""
+    return _memory_system.count(user_id)
 
 def safe_get_memories(memory_system, user_input: str, user_id: str) -> List[Dict]:
     """Safely get memories with error handling"""
@@ -329,23 +766,65 @@ def safe_get_memories(memory_system, user_input: str, user_id: str) -> List[Dict
 def format_memory_text(memories: List[Dict]) -> str:
     """Safely format memory text"""
     try:
-        memory_lines = []
-        for memory in memories:
-            if isinstance(memory, dict):
-                # Try different fields for memory content
-                content = (memory.get('memory') or 
-                          memory.get('content') or 
-                          memory.get('text') or 
-                          str(memory))
-                memory_lines.append(f"- {content}")
-        
-        return "\n".join(memory_lines)
+        # Try different fields for memory content
+        return "\n".join(
+            "- " + str(memory.get('memory') or memory.get('content') or memory.get('text') or memory)
+            for memory in memories
+            if isinstance(memory, dict)
+        )
     except Exception as e:
         logger.error(f"Error formatting memory text: {e}")
         return ""
 
+@st.cache_resource(show_spinner=False)
+def get_background_executor() -> ThreadPoolExecutor:
+    """Shared worker pool for overlapping memory I/O with the rest of a turn"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory-bot")
+
+@st.cache_resource(show_spinner=False)
+def get_memory_writer(_memory_system, backend: str) -> MemoryWriteBuffer:
+    """Shared write buffer for the process-wide memory backend"""
+    return MemoryWriteBuffer(_memory_system)
+
+@st.cache_resource(show_spinner=False)
+def get_memory_search(_memory_system, backend: str) -> CachedMemorySearch:
+    """Shared search cache for the process-wide memory backend"""
+    return CachedMemorySearch(_memory_system)
+
+def prefetch_memories(memory_system, user_id: str) -> None:
+    """Start the memory search for the typed message before Send is clicked"""
+    query = st.session_state.get("input", "")
+    if query.strip():
+        future = get_background_executor().submit(safe_get_memories, memory_system, query, user_id)
+        st.session_state.memory_prefetch = (user_id, query, future)
+
+def render_messages(messages: Iterable[ChatMessage]) -> None:
+    """Render messages, one chat bubble per run of consecutive same-role messages"""
+    for role, group in groupby(messages, key=attrgetter("role")):
+        try:
+            with st.chat_message(role):
+                st.write("\n\n".join(msg.content for msg in group))
+        except Exception as e:
+            logger.error(f"Error displaying {role} message: {e}")
+
+def is_duplicate_send(user_input: str) -> bool:
+    """Check whether this Send repeats the last user message within DUPLICATE_SEND_WINDOW"""
+    last_user = next(
+        (msg for msg in reversed(st.session_state.history) if msg.role == "user"),
+        None
+    )
+    return bool(
+        last_user
+        and last_user.content == user_input
+        and time.time() - st.session_state.get("last_send_ts", 0.0) < DUPLICATE_SEND_WINDOW
+    )
+
 # Initialize memory system
 memory, memory_type = initialize_memory()
+# Key the shared helpers by backend so they follow a switch from the fallback to Mem0
+memory_backend = type(memory).__name__
+memory_writer = get_memory_writer(memory, memory_backend)
+memory_search = get_memory_search(memory, memory_backend)
 
 # Streamlit Configuration
 st.set_page_config(
@@ -372,13 +851,24 @@ with st.sidebar:
     else:
         st.info(f"ℹ️ Using {memory_type}")
     
+    # Warn once if saved local memories could not be loaded
+    load_warning = getattr(memory, 'load_warning', None)
+    if load_warning:
+        memory.load_warning = None
+        st.warning(f"⚠️ {load_warning}")
+    
     # Memory management
     st.header("🛠️ Memory Management")
     if st.button("🗑️ Clear Memory", help="Clear all stored memories for this user"):
         try:
-            if hasattr(memory, 'memories') and user_id in memory.memories:
-                del memory.memories[user_id]
-                memory._save_memories()
+            if hasattr(memory, 'clear'):
+                cleared = memory_writer.clear(user_id)
+            else:
+                cleared = False
+            
+            if cleared:
+                memory_search.clear()
+                count_memories.clear()
                 st.success("✅ Memory cleared successfully!")
                 st.rerun()
             else:
@@ -388,7 +878,7 @@ with st.sidebar:
 
 # Initialize session state
 if "history" not in st.session_state:
-    st.session_state.history = []
+    st.session_state.history = deque(maxlen=MAX_SESSION_HISTORY)
 
 if "processing" not in st.session_state:
     st.session_state.processing = False
@@ -401,7 +891,9 @@ with col1:
         "💬 Your message:", 
         key="input", 
         placeholder="Type your message here...",
-        disabled=st.session_state.processing
+        disabled=st.session_state.processing,
+        on_change=prefetch_memories,
+        args=(memory_search, user_id)
     )
 
 with col2:
@@ -412,52 +904,55 @@ with col2:
     )
 
 # Process user input
-if send_button and user_input.strip():
+if send_button and user_input.strip() and not is_duplicate_send(user_input):
     st.session_state.processing = True
+    st.session_state.last_send_ts = time.time()
     
     with st.spinner("🔍 Processing your message..."):
         try:
-            # Get relevant memories
-            memories = safe_get_memories(memory, user_input, user_id)
-            
-            # Create system prompt
-            if memories:
-                memory_text = format_memory_text(memories)
-                system_prompt = f"""You are a helpful AI assistant with access to previous conversation memories.
-
-Here are relevant memories from our past conversations:
-{memory_text}
-
-Please use this context to provide more personalized and relevant responses. Reference the memories naturally if they're relevant to the current question."""
+            # Search memories in the background while the history context is prepared,
+            # reusing the search started when the input changed if it was for this message
+            prefetch = st.session_state.pop("memory_prefetch", None)
+            if prefetch and prefetch[:2] == (user_id, user_input):
+                search_future = prefetch[2]
             else:
-                system_prompt = "You are a helpful AI assistant. Provide clear and helpful responses to user questions."
+                search_future = get_background_executor().submit(safe_get_memories, memory_search, user_input, user_id)
+            
+            # Assemble the conversation in one list: a slot for the system prompt,
+            # recent history (trimmed to the token budget), then the new user turn
+            messages: List[Optional[Dict]] = [None]
+            messages.extend(select_recent_history(
+                st.session_state.history,
+                HISTORY_TOKEN_BUDGET - estimate_tokens(user_input)
+            ))
+            messages.append({"role": "user", "content": user_input})
+            
+            # Get relevant memories
+            memories = search_future.result()
             
-            # Prepare messages for API call
-            messages = [{"role": "system", "content": system_prompt}]
+            # Create system prompt, skipping the memory section when nothing matched
+            memory_text = format_memory_text(memories) if memories else ""
+            system_prompt = MEMORY_SYSTEM_PROMPT.format(memory_text=memory_text) if memory_text else DEFAULT_SYSTEM_PROMPT
+            messages[0] = {"role": "system", "content": system_prompt}
             
-            # Add recent conversation history (limit to avoid token overflow)
-            recent_history = st.session_state.history[-8:] if len(st.session_state.history) > 8 else st.session_state.history
-            for msg in recent_history:
-                if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                    messages.append({"role": msg["role"], "content": msg["content"]})
+            # Stream the AI response as tokens arrive
+            with st.chat_message("user"):
+                st.write(user_input)
+            with st.chat_message("assistant"):
+                ai_response = st.write_stream(groq_chat_stream(messages))
             
-            # Get AI response
-            ai_response = groq_chat(user_input, messages)
+            if not isinstance(ai_response, str) or not ai_response.strip():
+                ai_response = "❌ Empty response from AI"
             
             # Update session history
-            st.session_state.history.append({"role": "user", "content": user_input})
-            st.session_state.history.append({"role": "assistant", "content": ai_response})
+            turn = (ChatMessage("user", user_input), ChatMessage("assistant", ai_response))
+            st.session_state.history.extend(turn)
             
             # Store in memory
-            memory_messages = [
-                {"role": "user", "content": user_input},
-                {"role": "assistant", "content": ai_response}
-            ]
+            memory_messages = [msg._asdict() for msg in turn]
             
-            # Add to memory with error handling
-            success = memory.add(messages=memory_messages, user_id=user_id)
-            if not success:
-                st.warning("⚠️ Failed to save conversation to memory")
+            # Queue for a batched background write so Send doesn't wait on the memory backend
+            memory_writer.add(memory_messages, user_id)
                 
         except Exception as e:
             error_msg = f"❌ Error processing your request: {str(e)}"
@@ -472,18 +967,13 @@ Please use this context to provide more personalized and relevant responses. Ref
 st.subheader("💬 Conversation History")
 
 if st.session_state.history:
-    for i, msg in enumerate(st.session_state.history):
-        try:
-            if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                if msg["role"] == "user":
-                    with st.chat_message("user"):
-                        st.write(msg["content"])
-                elif msg["role"] == "assistant":
-                    with st.chat_message("assistant"):
-                        st.write(msg["content"])
-        except Exception as e:
-            logger.error(f"Error displaying message {i}: {e}")
-            continue
+    history = st.session_state.history
+    
+    # Only the most recent messages are rendered unless older ones are requested
+    older_count = max(0, len(history) - RENDERED_HISTORY)
+    if older_count and st.toggle(f"Show {older_count} older messages", key="show_older_history"):
+        render_messages(islice(history, older_count))
+    render_messages(islice(history, older_count, None))
 else:
     st.info("💡 No conversation history yet. Start chatting to see your messages here!")
 
@@ -497,11 +987,8 @@ with st.expander("🧠 Memory Status & Debug Info", expanded=False):
         
         # Show memory count
         try:
-            if hasattr(memory, 'memories'):
-                user_memories = memory.memories.get(user_id, [])
-                st.write(f"**Stored Memories:** {len(user_memories)}")
-            else:
-                st.write("**Stored Memories:** Unknown (using Mem0)")
+            memory_count = count_memories(memory, memory_backend, user_id, memory_writer.epoch)
+            st.write(f"**Stored Memories:** {memory_count if memory_count is not None else 'Unknown'}")
         except Exception as e:
             st.write(f"**Memory Error:** {e}")
     
@@ -532,14 +1019,14 @@ if not GROQ_API_KEY:
     5. Add it to your .env file as: `GROQ_API_KEY=your_key_here`
     """)
 
-if USE_MEM0 and not MEM0_API_KEY:
+if not MEM0_API_KEY:
     st.warning("⚠️ **MEM0_API_KEY** not found. Using local memory storage instead.")
 
 # Test API connection button
 if GROQ_API_KEY:
     if st.button("🔍 Test Groq API Connection"):
         with st.spinner("Testing API connection..."):
-            test_response = groq_chat("Hello, this is a test message.", [])
+            test_response = groq_chat([{"role": "user", "content": "Hello, this is a test message."}])
             if "❌" not in test_response:
                 st.success("✅ Groq API connection successful!")
             else: